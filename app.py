@@ -1,165 +1,322 @@
 
-import React, { useState, useRef, useCallback, useEffect } from 'react';
-import { v4 as uuidv4 } from 'uuid';
+import React, { useState, useRef, useCallback, useEffect, startTransition } from 'react';
 import ChatWindow from './components/ChatWindow';
 import ChatInput from './components/ChatInput';
-import { ChatMessage, ChatMessageType } from './types';
-import { sendMessageToGemini, textToSpeech, playAudioBuffer } from './services/geminiService';
-import { AUDIO_SAMPLE_RATE_OUTPUT, AUDIO_NUM_CHANNELS } from './constants';
-import { decodeAudioData, decode } from './services/audioUtils';
-
-// Helper function to detect keywords
-const containsKeywords = (text: string, keywords: string[]): boolean => {
-  const lowerText = text.toLowerCase();
-  return keywords.some(keyword => lowerText.includes(keyword.toLowerCase()));
+import { ChatMessage, ChatMessageType, Source } from './types';
+import { sendMessageToGemini, textToSpeech } from './services/geminiService';
+import { AUDIO_SAMPLE_RATE_OUTPUT } from './constants';
+import { concatAudioBuffers } from './services/audioUtils';
+import { getLruEntry, setLruEntry } from './services/cacheUtils';
+
+// Message ids only need to be unique within the session, so a counter suffices
+let lastMessageId = 0;
+const nextId = (): string => `m${++lastMessageId}`;
+
+const WELCOME_TEXT = "Halo! Saya adalah chatbot pendamping yang akan membantu Anda memahami dan menerapkan prinsip Universal Design for Learning (UDL) untuk anak berkebutuhan khusus. Apa yang ingin Anda tanyakan hari ini?";
+
+// Keywords that route a message to a specific model
+const SEARCH_KEYWORDS = ['terbaru', 'berita', 'fakta', 'siapa', 'dimana', 'kapan', 'saat ini', 'update', 'informasi terkini'];
+const COMPLEX_KEYWORDS = ['analisis', 'strategi komprehensif', 'desain pembelajaran universal', 'mendalam', 'bagaimana menerapkan', 'kompleks', 'tantangan'];
+
+// Compiles a keyword list into a single case-insensitive pattern that matches any of them
+const compileKeywords = (keywords: string[]): RegExp =>
+  new RegExp(keywords.map(keyword => keyword.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|'), 'i');
+
+// Compiled once at load so routing is a single scan per message
+const SEARCH_RE = compileKeywords(SEARCH_KEYWORDS);
+const COMPLEX_RE = compileKeywords(COMPLEX_KEYWORDS);
+
+// Messages are frozen once created, so every change must produce a new object
+const updatedMessage = (message: ChatMessage, changes: Partial<ChatMessage>): ChatMessage =>
+  Object.freeze({ ...message, ...changes });
+
+// Maximum number of messages kept in the chat history
+const MAX_VISIBLE_MESSAGES = 40;
+
+// Appends a message, dropping the oldest ones beyond the history window
+const withAppendedMessage = (messages: ChatMessage[], message: ChatMessage): ChatMessage[] =>
+  messages.length < MAX_VISIBLE_MESSAGES
+    ? [...messages, message]
+    : [...messages.slice(messages.length - MAX_VISIBLE_MESSAGES + 1), message];
+
+// Marks only the given message as playing, keeping unchanged messages by identity
+const withPlayingMessage = (messages: ChatMessage[], playingId: string): ChatMessage[] =>
+  messages.map(msg => {
+    const shouldPlay = msg.id === playingId;
+    return !!msg.audioPlaying === shouldPlay ? msg : updatedMessage(msg, { audioPlaying: shouldPlay });
+  });
+
+// Marks the given message as stopped, keeping unchanged messages by identity
+const withStoppedMessage = (messages: ChatMessage[], stoppedId: string): ChatMessage[] =>
+  messages.map(msg =>
+    msg.id === stoppedId && msg.audioPlaying ? updatedMessage(msg, { audioPlaying: false }) : msg
+  );
+
+// Maximum number of synthesized utterances kept in the TTS cache
+const TTS_CACHE_MAX_ENTRIES = 200;
+
+// Normalizes text into its TTS cache key
+const speechCacheKey = (text: string): string => text.trim().toLowerCase();
+
+// Shortest first sentence worth synthesizing on its own while the reply streams
+const MIN_FIRST_SENTENCE_LENGTH = 20;
+
+// Returns the length of the first complete sentence, or -1 if there is none yet.
+// Numbered list markers such as "1." are not treated as sentence ends.
+const firstSentenceLength = (text: string): number => {
+  for (const match of text.matchAll(/[.?!](?=\s)/g)) {
+    const end = match.index + 1;
+    const isListMarker = match[0] === '.' && /(^|\s)\d+$/.test(text.slice(0, match.index));
+    if (!isListMarker && end >= MIN_FIRST_SENTENCE_LENGTH) {
+      return end;
+    }
+  }
+  return -1;
 };
 
 function App() {
-  const [messages, setMessages] = useState<ChatMessage[]>([]);
+  // Start with the welcome message so the first render already shows it
+  const [messages, setMessages] = useState<ChatMessage[]>(() => [Object.freeze({
+    id: nextId(),
+    sender: ChatMessageType.BOT,
+    text: WELCOME_TEXT,
+    timestamp: new Date(),
+  })]);
   const [isLoading, setIsLoading] = useState(false);
   const audioBuffersRef = useRef<Map<string, AudioBuffer>>(new Map()); // Store generated audio buffers
+  const ttsCacheRef = useRef<Map<string, AudioBuffer>>(new Map()); // Synthesized audio keyed by normalized text, in LRU order
   const audioContextRef = useRef<AudioContext | null>(null);
   const audioSourceRef = useRef<AudioBufferSourceNode | null>(null);
+  const ttsAbortRef = useRef<AbortController | null>(null); // Cancels speech synthesis for the latest reply
 
-  // Initialize AudioContext on mount
+  // Clean up audio context on unmount; it is only created once audio is played
   useEffect(() => {
-    // FIX: Remove deprecated webkitAudioContext, as AudioContext is now widely supported.
-    audioContextRef.current = new AudioContext({ sampleRate: AUDIO_SAMPLE_RATE_OUTPUT });
     return () => {
-      // Clean up audio context on unmount
       audioContextRef.current?.close();
+      audioContextRef.current = null;
     };
   }, []);
 
+  // Forget the per-message audio references for messages that have dropped out
+  // of the history window. The buffers themselves stay alive while ttsCacheRef
+  // holds them, so decoded audio memory is bounded by TTS_CACHE_MAX_ENTRIES plus
+  // the visible messages, not by the window alone. Only previously rendered
+  // messages are considered, so audio stored for a message whose append is still
+  // pending in a transition is kept.
+  const renderedMessagesRef = useRef<ChatMessage[]>([]);
+  useEffect(() => {
+    const visibleIds = new Set(messages.map(msg => msg.id));
+    for (const msg of renderedMessagesRef.current) {
+      if (!visibleIds.has(msg.id)) audioBuffersRef.current.delete(msg.id);
+    }
+    renderedMessagesRef.current = messages;
+  }, [messages]);
+
+  // Returns the audio for the given text, synthesizing it only on a cache miss.
+  // Buffers are shared between messages with the same text, never copied.
+  const getSpeechAudio = useCallback(async (text: string, signal?: AbortSignal): Promise<AudioBuffer> => {
+    const key = speechCacheKey(text);
+    const cached = getLruEntry(ttsCacheRef.current, key);
+    if (cached) {
+      return cached;
+    }
+    const audioBuffer = await textToSpeech(text, signal);
+    setLruEntry(ttsCacheRef.current, key, audioBuffer, TTS_CACHE_MAX_ENTRIES);
+    return audioBuffer;
+  }, []);
+
   const handleSendMessage = useCallback(async (text: string) => {
-    const userMessage: ChatMessage = {
-      id: uuidv4(),
+    // Cancel any speech synthesis still pending for the previous reply
+    ttsAbortRef.current?.abort();
+    const ttsController = new AbortController();
+    ttsAbortRef.current = ttsController;
+
+    const userMessage: ChatMessage = Object.freeze({
+      id: nextId(),
       sender: ChatMessageType.USER,
       text: text,
       timestamp: new Date(),
-    };
-    setMessages((prev) => [...prev, userMessage]);
+    });
+    setMessages((prev) => withAppendedMessage(prev, userMessage));
     setIsLoading(true);
 
+    const botMessageId = nextId();
+    let botText = '';
+    let firstSentence = '';
+    let firstSentenceAudio: Promise<AudioBuffer> | null = null;
+
     try {
-      let modelType: 'flash-lite' | 'flash-search' | 'pro-thinking' = 'flash-lite';
-      const searchKeywords = ['terbaru', 'berita', 'fakta', 'siapa', 'dimana', 'kapan', 'saat ini', 'update', 'informasi terkini'];
-      const complexKeywords = ['analisis', 'strategi komprehensif', 'desain pembelajaran universal', 'mendalam', 'bagaimana menerapkan', 'kompleks', 'tantangan'];
-
-      if (containsKeywords(text, searchKeywords)) {
-        modelType = 'flash-search';
-      } else if (containsKeywords(text, complexKeywords) || text.length > 100) { // Simple heuristic for longer, complex queries
-        modelType = 'pro-thinking';
-      }
+      const modelType: 'flash-lite' | 'flash-search' | 'pro-thinking' = SEARCH_RE.test(text)
+        ? 'flash-search'
+        : (COMPLEX_RE.test(text) || text.length > 100) // Simple heuristic for longer, complex queries
+          ? 'pro-thinking'
+          : 'flash-lite';
 
-      const geminiResponse = await sendMessageToGemini(text, modelType);
+      let sources: Source[] | undefined;
+      let botMessageShown = false;
+      for await (const chunk of sendMessageToGemini(text, modelType)) {
+        botText += chunk.text;
+        sources = chunk.sources ?? sources;
 
-      const botMessage: ChatMessage = {
-        id: uuidv4(),
-        sender: ChatMessageType.BOT,
-        text: geminiResponse.text,
-        timestamp: new Date(),
-        sources: geminiResponse.sources,
-      };
+        // Start synthesizing the first sentence while the rest is still streaming,
+        // unless the text so far is a reply whose joined audio is already cached
+        if (!firstSentenceAudio && !ttsCacheRef.current.has(speechCacheKey(botText))) {
+          const sentenceEnd = firstSentenceLength(botText);
+          if (sentenceEnd !== -1) {
+            firstSentence = botText.slice(0, sentenceEnd);
+            firstSentenceAudio = getSpeechAudio(firstSentence, ttsController.signal);
+            // Mark the rejection as handled now, since the stream may run for seconds before
+            // the Promise.all below awaits it; that await still sees the failure
+            firstSentenceAudio.catch(() => {});
+          }
+        }
 
-      // Generate TTS audio
-      try {
-        const audioBuffer = await textToSpeech(geminiResponse.text);
-        audioBuffersRef.current.set(botMessage.id, audioBuffer);
-        // Only set audioBlob if generation was successful
-        botMessage.audioBlob = new Blob([], { type: 'audio/pcm' }); // Placeholder blob to indicate audio is available
-      } catch (audioError) {
-        console.error("Failed to generate TTS audio:", audioError);
-        // Continue without audio if TTS fails
+        if (!botMessageShown) {
+          const botMessage: ChatMessage = Object.freeze({
+            id: botMessageId,
+            sender: ChatMessageType.BOT,
+            text: botText,
+            timestamp: new Date(),
+            sources,
+          });
+          // Bot updates are non-urgent so the input stays responsive while the list re-renders
+          startTransition(() => setMessages((prev) => withAppendedMessage(prev, botMessage)));
+          botMessageShown = true;
+        } else {
+          const streamedText = botText;
+          const streamedSources = sources;
+          startTransition(() => setMessages((prev) => prev.map(msg =>
+            msg.id === botMessageId ? updatedMessage(msg, { text: streamedText, sources: streamedSources }) : msg
+          )));
+        }
       }
-
-      setMessages((prev) => [...prev, botMessage]);
-
     } catch (error: any) {
       console.error("Error sending message to Gemini:", error);
-      const errorMessage: ChatMessage = {
-        id: uuidv4(),
+      // Drop any speech already requested for the partial reply
+      ttsController.abort();
+      const errorMessage: ChatMessage = Object.freeze({
+        id: nextId(),
         sender: ChatMessageType.ERROR,
         text: `Terjadi kesalahan: ${error.message || 'Tidak dapat menghubungi AI.'}`,
         timestamp: new Date(),
-      };
-      setMessages((prev) => [...prev, errorMessage]);
+      });
+      startTransition(() => setMessages((prev) => withAppendedMessage(prev, errorMessage)));
+      return;
     } finally {
       setIsLoading(false);
     }
-  }, []); // eslint-disable-next-line react-hooks/exhaustive-deps
 
-  const handlePlayAudio = useCallback(async (messageId: string) => {
-    const messageToPlay = messages.find(msg => msg.id === messageId);
-    if (!messageToPlay || !audioContextRef.current) return;
+    // Nothing to speak if the reply was only whitespace
+    if (!botText.trim()) {
+      return;
+    }
 
+    // Generate TTS audio; the first sentence may already be in flight
+    try {
+      const replyKey = speechCacheKey(botText);
+      let audioBuffer = getLruEntry(ttsCacheRef.current, replyKey);
+      if (audioBuffer) {
+        // A repeated reply reuses its joined audio, so any early first sentence is not needed
+        ttsController.abort();
+      } else {
+        const restText = botText.slice(firstSentence.length).trim();
+        const segments = await Promise.all([
+          firstSentenceAudio,
+          restText ? getSpeechAudio(restText, ttsController.signal) : null,
+        ]);
+        const spokenSegments = segments.filter((segment): segment is AudioBuffer => segment !== null);
+        audioBuffer = concatAudioBuffers(spokenSegments);
+        if (spokenSegments.length > 1) {
+          // Keep only the joined reply cached so its audio is not held twice
+          ttsCacheRef.current.delete(speechCacheKey(firstSentence));
+          ttsCacheRef.current.delete(speechCacheKey(restText));
+          setLruEntry(ttsCacheRef.current, replyKey, audioBuffer, TTS_CACHE_MAX_ENTRIES);
+        }
+      }
+      audioBuffersRef.current.set(botMessageId, audioBuffer);
+      // Only set hasAudio if generation was successful
+      startTransition(() => setMessages((prev) => prev.map(msg =>
+        msg.id === botMessageId ? updatedMessage(msg, { hasAudio: true }) : msg
+      )));
+    } catch (audioError) {
+      // Continue without audio if TTS fails or was cancelled by a newer message
+      if (!ttsController.signal.aborted) {
+        console.error("Failed to generate TTS audio:", audioError);
+      }
+    }
+  }, [getSpeechAudio]); // eslint-disable-next-line react-hooks/exhaustive-deps
+
+  const handlePlayAudio = useCallback(async (messageId: string) => {
+    // Audio buffers are indexed by message id, so no scan of the messages is needed
     const audioBuffer = audioBuffersRef.current.get(messageId);
 
     if (audioBuffer) {
-      // Stop any currently playing audio and update its state
-      setMessages(prevMessages => prevMessages.map(msg =>
-        msg.audioPlaying ? { ...msg, audioPlaying: false } : msg
-      ));
+      // Create the AudioContext lazily inside the user gesture that plays audio
+      if (!audioContextRef.current) {
+        audioContextRef.current = new AudioContext({ sampleRate: AUDIO_SAMPLE_RATE_OUTPUT });
+      }
+      if (audioContextRef.current.state === 'suspended') {
+        await audioContextRef.current.resume();
+      }
+
+      // Release the previous source so rapid clicks don't leave nodes lingering
+      if (audioSourceRef.current) {
+        const previousSource = audioSourceRef.current;
+        previousSource.onended = null;
+        try {
+          previousSource.stop();
+        } catch (error) {
+          console.warn("Could not stop previous audio source:", error);
+        }
+        previousSource.disconnect();
+        audioSourceRef.current = null;
+      }
 
-      // Create a new source for playback
+      // Create a new source for playback; the decoded buffer is shared by reference, never copied
       const source = audioContextRef.current.createBufferSource();
       source.buffer = audioBuffer;
       source.connect(audioContextRef.current.destination);
 
       source.onended = () => {
-        setMessages(prevMessages =>
-          prevMessages.map(msg =>
-            msg.id === messageId ? { ...msg, audioPlaying: false } : msg
-          )
-        );
-        audioSourceRef.current = null;
+        // Drop the buffer reference so it can be collected once evicted from the TTS cache
+        source.disconnect();
+        source.buffer = null;
+        setMessages(prevMessages => withStoppedMessage(prevMessages, messageId));
+        if (audioSourceRef.current === source) {
+          audioSourceRef.current = null;
+        }
       };
 
       audioSourceRef.current = source;
       source.start(0);
 
-      setMessages(prevMessages =>
-        prevMessages.map(msg =>
-          msg.id === messageId ? { ...msg, audioPlaying: true } : msg
-        )
-      );
+      // Stop the indicator on any other message and mark this one as playing in one pass
+      setMessages(prevMessages => withPlayingMessage(prevMessages, messageId));
     } else {
       console.warn(`Audio buffer not found for message ID: ${messageId}`);
     }
-  }, [messages]);
+  }, []);
 
   const handleStopAudio = useCallback((messageId: string) => {
     if (audioSourceRef.current) {
       try {
         audioSourceRef.current.stop();
         audioSourceRef.current = null;
-        setMessages(prevMessages =>
-          prevMessages.map(msg =>
-            msg.id === messageId ? { ...msg, audioPlaying: false } : msg
-          )
-        );
+        setMessages(prevMessages => withStoppedMessage(prevMessages, messageId));
       } catch (error) {
         console.error("Error stopping audio source:", error);
       }
     }
   }, []);
 
-  // Initial welcome message
+  // Pre-generate welcome message audio, seeding the TTS cache
   useEffect(() => {
-    const welcomeMessage: ChatMessage = {
-      id: uuidv4(),
-      sender: ChatMessageType.BOT,
-      text: "Halo! Saya adalah chatbot pendamping yang akan membantu Anda memahami dan menerapkan prinsip Universal Design for Learning (UDL) untuk anak berkebutuhan khusus. Apa yang ingin Anda tanyakan hari ini?",
-      timestamp: new Date(),
-    };
-    setMessages([welcomeMessage]);
-
-    // Pre-generate welcome message audio
+    const welcomeMessageId = messages[0].id;
     const generateWelcomeAudio = async () => {
       try {
-        const audioBuffer = await textToSpeech(welcomeMessage.text);
-        audioBuffersRef.current.set(welcomeMessage.id, audioBuffer);
-        setMessages(prev => prev.map(msg => msg.id === welcomeMessage.id ? { ...msg, audioBlob: new Blob([], { type: 'audio/pcm' }) } : msg));
+        const audioBuffer = await getSpeechAudio(WELCOME_TEXT);
+        audioBuffersRef.current.set(welcomeMessageId, audioBuffer);
+        setMessages(prev => prev.map(msg => msg.id === welcomeMessageId ? updatedMessage(msg, { hasAudio: true }) : msg));
       } catch (error) {
         console.error("Failed to pre-generate welcome message audio:", error);
       }